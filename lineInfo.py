@@ -4,9 +4,10 @@ Define nmolec class that stores information for all gas.
 Da Pan, 02122016.
 """
 import scipy.io as io
+import numpy as np
 import os
 
-molecWeight = {"N2O": 44.0055,
+molecWeight ={"N2O": 44.0055,
                "CO": 28.0101,
                "H2O": 18.0153,
                'C2H2': 26.0373,
@@ -18,14 +19,125 @@ molecWeight = {"N2O": 44.0055,
                'N2': 28.01340}
 
 
+def _sortByNu(info):
+    """ Sort line arrays by line center wavenumber, in place.
+
+    Reorders every array that runs parallel to the 'nu' column, so
+    consumers can window the table with np.searchsorted instead of
+    scanning every line.
+    :param info: dict of line info arrays
+    :return: the same dict, arrays sorted by nu
+    """
+    nu = info.get('nu')
+    if nu is None:
+        return info
+    order = np.argsort(nu.ravel())
+    nLines = nu.shape[0]
+    for key, value in info.items():
+        if isinstance(value, np.ndarray) and value.shape[:1] == (nLines,):
+            info[key] = value[order]
+    return info
+
+
+def matToNpz(location):
+    """ One-time migration of mat line files to npz arrays.
+
+    Reads every <molec>.mat in location, drops the MATLAB bookkeeping
+    entries, and writes the remaining line arrays to <molec>.npz as
+    contiguous float arrays sorted by nu. _load_hitran prefers the npz
+    when present, which skips the MATLAB parser on every later load.
+    :param location: directory of HITRAN line info files
+    :return: list of molec names converted
+    """
+    converted = []
+    for fname in os.listdir(location):
+        molec, ext = os.path.splitext(fname)
+        if ext != '.mat':
+            continue
+        info = io.loadmat(os.path.join(location, fname))
+        for key in ('__version__', '__globals__', '__header__'):
+            info.pop(key, None)
+        _sortByNu(info)
+        arrays = dict((key, np.ascontiguousarray(value))
+                      for key, value in info.items())
+        np.savez(os.path.join(location, molec + '.npz'), **arrays)
+        converted.append(molec)
+    return converted
+
+
+_hitranCache = {}  # parsed line info per (location, molec)
+
+
+def _load_hitran(location, molec):
+    """ Load HITRAN line info for one gas.
+
+    Prefers <molec>.npz (see matToNpz); npz members are read lazily per
+    array, so only the columns actually used get pulled into memory.
+    Falls back to the original mat file. Results are cached per
+    (location, molec) so adding the same gas repeatedly (e.g. at
+    different T/P) does not re-parse the file.
+    :param location: directory of HITRAN line info files
+    :param molec: molec name of gas
+    :return: dict-like of line info arrays
+    """
+    key = (location, molec)
+    if key in _hitranCache:
+        return _hitranCache[key]
+    _hitranCache[key] = info = _read_hitran(location, molec)
+    return info
+
+
+def _read_hitran(location, molec):
+    npzPath = os.path.join(location, molec + '.npz')
+    if os.path.isfile(npzPath):
+        # npz members were already sorted by nu when written (matToNpz)
+        return np.load(npzPath)
+
+    info = io.loadmat(os.path.join(location, molec + '.mat'))
+
+    # Get rid of MATLAB info
+    for key in ('__version__', '__globals__', '__header__'):
+        info.pop(key, None)
+
+    return _sortByNu(info)
+
+
+# One record per stored gas; keeping the columns in a single structured
+# array lets downstream code broadcast T/P against line arrays directly.
+gasDtype = np.dtype([('molec', 'U10'), ('T', 'f8'), ('P', 'f8')])
+
+
 class ngas:
     def __init__(self):
-        self.T = []  # T is a list storing T for each gas
-        self.P = []  # P is a list storing P for each gas
-        self.molec = []  # Name list of molecules
+        self.gases = np.empty(4, dtype=gasDtype)  # grown geometrically
+        self.ngases = 0  # number of valid records in gases
         self.hinfo = {}  # A dict to store HITRAN info
         self.location = "./Data"  # Location of HITRAN line info files
 
+    def __grow(self, extra):
+        """ Make room for extra more records, doubling capacity as needed.
+        :param extra: number of records about to be appended
+        :return: None
+        """
+        need = self.ngases + extra
+        size = len(self.gases)
+        if need > size:
+            while size < need:
+                size *= 2
+            self.gases = np.resize(self.gases, size)
+
+    @property
+    def molec(self):
+        return self.gases['molec'][:self.ngases]
+
+    @property
+    def T(self):
+        return self.gases['T'][:self.ngases]
+
+    @property
+    def P(self):
+        return self.gases['P'][:self.ngases]
+
     # TODO for now the function reads mat file, future version should read txt directly
     def __getinfo(self, molec):
         """ Get gas line information from mat files
@@ -33,21 +145,9 @@ class ngas:
         :return: None
         Note: User is not recommended to use this function. Since it won't add
         """
-        cwd = os.getcwd()
-        os.chdir(self.location)
-
-        molecset = set(molec)  # Get rid of redundancy for dict
-
-        # Load mat file
+        # Load mat file; _load_hitran caches so repeat adds are dict lookups
         if molec not in self.hinfo.keys():
-            self.hinfo[molec] = io.loadmat(molec + '.mat')
-
-            # Get rid of MATLAB info
-            self.hinfo[molec].pop('__version__')
-            self.hinfo[molec].pop('__globals__')
-            self.hinfo[molec].pop('__header__')
-
-        os.chdir(cwd)
+            self.hinfo[molec] = _load_hitran(self.location, molec)
 
     def addgas(self, molec, T, P):
         """ Add single gas to the class.
@@ -59,9 +159,9 @@ class ngas:
         if type(molec) == str:
             print("Please enter a gas name. For multiple gases, use setngas instead.")  # Prompt for correct input
         else:
-            self.molec.append(molec)
-            self.T.append(T)
-            self.P.append(P)
+            self.__grow(1)
+            self.gases[self.ngases] = (molec, T, P)
+            self.ngases += 1
             self.__getinfo(molec)
 
     def setngas(self, molecTable):
@@ -70,10 +170,10 @@ class ngas:
                                                 ('H2O', 283.15, 1.015e5)]
         :return: None
         """
+        self.__grow(len(molecTable))
         for gas in molecTable:
-            self.molec.append(gas[0])
-            self.T.append(gas[1])
-            self.P.append(gas[2])
+            self.gases[self.ngases] = (gas[0], gas[1], gas[2])
+            self.ngases += 1
             self.__getinfo(gas[0])
 
     def clear(self):
@@ -0,0 +1,236 @@
+"""
+Notes
+-----
+Vectorized line shape kernels for specCal, accumulating the complex
+probability function over all lines of a table in one pass.
+
+When numba is importable the accumulation loop is jit compiled on first
+use (import is deferred so GUI startup pays nothing) and evaluates the
+Humlicek (1982) w4 rational approximation, the same approximation HAPI
+uses internally. Otherwise a NumPy implementation vectorized over the
+wavenumber grid is used, built on scipy's exact wofz near line center
+with the Humlicek region-I asymptote in the far zone.
+
+Author
+------
+Da Pan,
+Department of Civil and Environmental Engineering,
+Princeton University
+Email: dp7@princeton.edu
+"""
+
+import numpy as np
+from scipy.special import wofz
+
+sqrtLn2 = np.sqrt(np.log(2.))
+sqrtPi = np.sqrt(np.pi)
+recSqrtPi = 1. / sqrtPi
+
+# Beyond this distance from line center (cm-1) the Voigt profile is
+# replaced by a reference Lorentzian rescaled to match the exact value
+# at the boundary; in the far wing the two agree to well below 1%.
+wingSplit = 4.0
+
+_voigtKernel = None  # chosen (and possibly jit compiled) on first call
+
+
+def humlicekW4(x, y):
+    """
+    Real part of the complex probability function w(z), z = x + iy,
+    vectorized over x. y is a scalar (one line at a time).
+
+    The asymptotic region |x| + y >= 15 uses the Humlicek (1982)
+    region-I rational (one complex divide, accurate to ~1e-6 there);
+    everything closer to line center is exact via scipy's wofz.
+
+    Parameters
+    ----------
+    x: array
+        Scaled distance from line center.
+    y: float
+        Scaled Lorentz half width.
+
+    Returns
+    -------
+    K: array
+        Re(w(x + iy)), the Voigt function up to normalization.
+    """
+    s = np.abs(x) + y
+    K = np.empty(x.shape)
+
+    m1 = s >= 15.
+    if np.any(m1):
+        t1 = y - 1j * x[m1]
+        K[m1] = (t1 * 0.5641896 / (0.5 + t1 * t1)).real
+    inner = ~m1
+    if np.any(inner):
+        K[inner] = wofz(x[inner] + 1j * y).real
+    return K
+
+
+def _w4Scalar(x, y):
+    """
+    Scalar Humlicek w4 evaluation, Re(w(x + iy)); kept free of NumPy
+    array operations so it can be njit compiled and inlined.
+    """
+    t = complex(y, -x)
+    s = abs(x) + y
+    if s >= 15.:
+        w = t * 0.5641896 / (0.5 + t * t)
+    elif s >= 5.5:
+        u = t * t
+        w = t * (1.410474 + u * 0.5641896) / (0.75 + u * (3. + u))
+    elif y >= 0.195 * abs(x) - 0.176:
+        w = (16.4955 + t * (20.20933 + t * (11.96482 + t * (
+            3.778987 + t * 0.5642236)))) / \
+            (16.4955 + t * (38.82363 + t * (39.27121 + t * (
+                21.69274 + t * (6.699398 + t)))))
+    else:
+        u = t * t
+        w = np.exp(u) - t * (36183.31 - u * (3321.9905 - u * (
+            1540.787 - u * (219.0313 - u * (35.76683 - u * (
+                1.320522 - u * 0.56419)))))) / \
+            (32066.6 - u * (24322.84 - u * (9022.228 - u * (
+                2186.181 - u * (364.2191 - u * (61.57037 - u * (
+                    1.841439 - u)))))))
+    return w.real
+
+
+def _voigtDenseBlocks(nu, nu0, sw, gammaD, gamma0, out, blockSize):
+    """
+    Exact wofz evaluation over blocks of blockSize lines at a time, so
+    the (len(nu), blockSize) intermediate stays cache resident instead
+    of materializing the full grid-by-lines matrix.
+    """
+    # Line centers resolve far below float32 grid spacing, so distances
+    # from center are formed in float64 even for an FP32 grid; only the
+    # accumulation into out stays in the grid precision.
+    nu64 = np.asarray(nu, dtype=np.float64)
+    for lo in range(0, len(nu0), blockSize):
+        hi = min(lo + blockSize, len(nu0))
+        cte = sqrtLn2 / gammaD[lo:hi]
+        x = (nu64[:, None] - nu0[None, lo:hi]) * cte[None, :]
+        k = wofz(x + 1j * (gamma0[lo:hi] * cte)[None, :]).real
+        k *= (sw[lo:hi] * cte * recSqrtPi)[None, :]
+        out += k.sum(axis=1)
+
+
+def _voigtAccumulateNumpy(nu, nu0, sw, gammaD, gamma0, out, iCut, blockSize):
+    """
+    NumPy fallback: loop over lines, vectorize over the nu grid. Exact
+    probability function within wingSplit of line center, rescaled
+    Lorentzian beyond, and nothing at all past the per-line radius
+    where the Lorentzian wing drops below iCut. Without a cutoff every
+    line touches the whole grid anyway, so that case goes through the
+    blocked dense evaluation instead of the per-line loop.
+    """
+    if iCut <= 0.:
+        _voigtDenseBlocks(nu, nu0, sw, gammaD, gamma0, out, blockSize)
+        return
+    # As in the dense path, distances from line center are computed in
+    # float64 — an FP32 grid would otherwise demote the line center and
+    # shift it by a noticeable fraction of a Doppler width.
+    nu64 = np.asarray(nu, dtype=np.float64)
+    for k in range(len(nu0)):
+        cte = sqrtLn2 / gammaD[k]
+        y = gamma0[k] * cte
+        amp = sw[k] * cte * recSqrtPi
+        rMax = np.sqrt(sw[k] * gamma0[k] / (np.pi * iCut))
+        lo = np.searchsorted(nu, nu0[k] - rMax)
+        hi = np.searchsorted(nu, nu0[k] + rMax)
+        if hi <= lo:
+            continue
+        window = out[lo:hi]
+        dv = nu64[lo:hi] - nu0[k]
+        near = np.abs(dv) <= wingSplit
+        window[near] += amp * humlicekW4(dv[near] * cte, y)
+        if not near.all():
+            far = ~near
+            gl2 = gamma0[k] * gamma0[k]
+            kb = _w4Scalar(wingSplit * cte, y)
+            window[far] += amp * kb * (wingSplit * wingSplit + gl2) / (
+                dv[far] * dv[far] + gl2)
+
+
+def _voigtAccumulatePython(nu, nu0, sw, gammaD, gamma0, out, iCut, blockSize):
+    """
+    Scalar accumulation loop handed to numba.njit. Exact w4 within
+    wingSplit of line center; beyond that a Lorentzian rescaled to the
+    boundary value, so the profile stays continuous at the split; and
+    nothing past the per-line radius where the Lorentzian wing drops
+    below iCut.
+    """
+    for k in range(len(nu0)):
+        cte = sqrtLn2 / gammaD[k]
+        y = gamma0[k] * cte
+        amp = sw[k] * cte * recSqrtPi
+        gl2 = gamma0[k] * gamma0[k]
+        farScale = amp * _w4Scalar(wingSplit * cte, y) * (
+            wingSplit * wingSplit + gl2)
+        if iCut > 0.:
+            rMax = np.sqrt(sw[k] * gamma0[k] / (np.pi * iCut))
+            lo = np.searchsorted(nu, nu0[k] - rMax)
+            hi = np.searchsorted(nu, nu0[k] + rMax)
+        else:
+            lo, hi = 0, len(nu)
+        for i in range(lo, hi):
+            dv = nu[i] - nu0[k]
+            if abs(dv) <= wingSplit:
+                out[i] += amp * _w4Scalar(dv * cte, y)
+            else:
+                out[i] += farScale / (dv * dv + gl2)
+
+
+def _buildVoigtKernel():
+    global _w4Scalar
+    try:
+        from numba import njit
+    except ImportError:
+        return _voigtAccumulateNumpy
+    _w4Scalar = njit(cache=True, fastmath=True, nogil=True)(_w4Scalar)
+    return njit(cache=True, fastmath=True, nogil=True)(_voigtAccumulatePython)
+
+
+def voigtAccumulate(nu, nu0, sw, gammaD, gamma0, out, iCut=0., blockSize=512):
+    """
+    Accumulate sum_k sw_k * K(x_k, y_k) * sqrt(ln2/pi)/gammaD_k into out.
+
+    Parameters
+    ----------
+    nu: array
+        Wavenumber grid in cm-1 (monotonic ascending).
+    nu0: array
+        (Pressure shifted) line centers in cm-1.
+    sw: array
+        Line intensities at the actual temperature.
+    gammaD: array
+        Doppler HWHMs in cm-1.
+    gamma0: array
+        Pressure broadened HWHMs in cm-1.
+    out: array
+        Cross-section accumulator, same length as nu; modified in place.
+    iCut: float, default=0.
+        When positive, each line is only evaluated within the radius
+        sqrt(sw*gamma0/(pi*iCut)) of its center, beyond which its
+        Lorentzian wing contributes less than iCut per point. Zero
+        disables the cutoff.
+    blockSize: int, default=512
+        Lines per block in the dense (no-cutoff) NumPy path; bounds the
+        grid-by-lines intermediate so it stays cache resident. Ignored
+        by the jit kernel, which accumulates scalar by scalar.
+
+    Returns
+    -------
+
+    """
+    global _voigtKernel
+    if _voigtKernel is None:
+        _voigtKernel = _buildVoigtKernel()
+    # nu and out keep their dtype so an FP32 grid runs (and accumulates)
+    # in single precision; the per-line parameters stay float64.
+    _voigtKernel(np.ascontiguousarray(nu),
+                 np.ascontiguousarray(nu0, dtype=np.float64),
+                 np.ascontiguousarray(sw, dtype=np.float64),
+                 np.ascontiguousarray(gammaD, dtype=np.float64),
+                 np.ascontiguousarray(gamma0, dtype=np.float64),
+                 out, float(iCut), int(blockSize))
@@ -14,7 +14,7 @@ from PyQt4 import QtGui, QtCore
 import sys
 import os
 import gasPropertyWidget
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt4agg import \
     NavigationToolbar2QT as NavigationToolbar
@@ -27,14 +27,22 @@ class mplCanvas(QtGui.QWidget):
     def __init__(self, parent=None, width=5, height=4, dpi=100, bgcolor='#ffffff'):
         super(mplCanvas, self).__init__(parent)
 
-        # a figure instance to plot on
-        self.figure = plt.figure(figsize=(width, height), dpi=dpi, facecolor=bgcolor)
+        # a figure instance to plot on; plain Figure keeps the canvas out
+        # of the pyplot state machine
+        self.figure = Figure(figsize=(width, height), dpi=dpi, facecolor=bgcolor)
         self.axes = self.figure.add_subplot(111)
-        self.axes.hold(False)
+        # hold stays on (the default): plotDas/plotWms clear the axis
+        # explicitly when they cannot reuse the existing lines, and
+        # hold(False) would make every plot call wipe the axis first.
+        self.lines = {}  # persistent Line2D handles, reused across replots
+        self.background = None  # blit background, recaptured on full draws
+        self.bgLims = None  # axis limits the background was captured with
+        self.bgLabels = None  # line labels baked into the background legend
         self.index = 0
         # this is the Canvas Widget that displays the `figure`
         # it takes the `figure` instance as a parameter to __init__
         self.canvas = FigureCanvas(self.figure)
+        self.canvas.mpl_connect('draw_event', self.onDraw)
         FigureCanvas.setSizePolicy(self.canvas,
                                    QtGui.QSizePolicy.Expanding,
                                    QtGui.QSizePolicy.Expanding)
@@ -58,12 +66,84 @@ class mplCanvas(QtGui.QWidget):
         layout.addLayout(buttonHBox)
         self.setLayout(layout)
 
+    def onDraw(self, event):
+        # Every full draw happens with the data lines animated (excluded
+        # from the render), so the captured region is a clean background
+        # that blitLines can restore under fresh line data.
+        self.background = self.canvas.copy_from_bbox(self.axes.bbox)
+        self.drawLines()
+
+    def drawLines(self):
+        for line in self.lines.values():
+            self.axes.draw_artist(line)
+        self.canvas.blit(self.axes.bbox)
+
+    def blitLines(self):
+        # Fast path when only the line data changed: restore the cached
+        # background and composite the lines, skipping the full redraw.
+        if self.background is None:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        self.drawLines()
+
+
+class HapiLoader(QtCore.QThread):
+    """Load a HAPI pickle database off the GUI thread.
+
+    db_begin_pickle can take seconds on a large database; running it here
+    keeps the event loop responsive and lets paint events proceed.
+    """
+    loaded = QtCore.pyqtSignal()
+
+    def __init__(self, dbDir, parent=None):
+        super(HapiLoader, self).__init__(parent)
+        self.dbDir = dbDir
+
+    def run(self):
+        hapi.db_begin_pickle(self.dbDir)
+        self.loaded.emit()
+
+
+class CalcSignals(QtCore.QObject):
+    # QRunnable is not a QObject, so the finished signal lives on this
+    # small holder; emitted as (panel index, results, kind, mode).
+    done = QtCore.pyqtSignal(int, object, str, str)
+
+
+class CalcRunnable(QtCore.QRunnable):
+    """Run one panel's spectrum calculation on the global thread pool.
+
+    Panels are independent (different gas lists / modes), so 2- and
+    4-panel comparisons compute concurrently; only drawing stays on the
+    GUI thread, via the done signal.
+    """
+
+    def __init__(self, index, func, args, kwargs, kind, mode):
+        super(CalcRunnable, self).__init__()
+        self.index = index
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.kind = kind
+        self.mode = mode
+        self.signals = CalcSignals()
+
+    def run(self):
+        results = self.func(*self.args, **self.kwargs)
+        self.signals.done.emit(self.index, results, self.kind, self.mode)
+
 
 class AppWindow(QtGui.QMainWindow):
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, scrsz=None):
         super(AppWindow, self).__init__(parent)
         self.setWindowTitle('QCLAS')
-        self.scrsz = QtGui.QDesktopWidget().availableGeometry().getRect()
+        # The screen geometry is queried once at app start and passed in;
+        # instantiating QDesktopWidget here repeats a synchronous round
+        # trip to the window system per window.
+        if scrsz is None:
+            scrsz = QtGui.QDesktopWidget().availableGeometry().getRect()
+        self.scrsz = scrsz
         self.dpi = int(self.scrsz[2] / 25)
         self.initUI()
 
@@ -75,6 +155,10 @@ class AppWindow(QtGui.QMainWindow):
 
         self.initMenu()
         self.gasListLabel = QtGui.QLabel()
+        self.gasNuRange = {}
+        self.nuCache = {}
+        self.sigmaCache = {}  # bare cross-sections keyed by (gas, T, P, ...)
+        self.buildMolIdMap()
         self.calGasList = []
         self.canvasList = []
         self.setGasListLabel()
@@ -82,6 +166,7 @@ class AppWindow(QtGui.QMainWindow):
         self.mainWidget = QtGui.QWidget()
         self.setFrames()
         self.setLeftColumn()
+        self.buildCanvasPool()
         self.setCanvas()
         self.laserSpec = None
 
@@ -90,8 +175,8 @@ class AppWindow(QtGui.QMainWindow):
 
     def initMenu(self):
         # HITRAN Data menu
-        chHapiDir = QtGui.QAction('&Change HITRAN Dir', self)
-        chHapiDir.triggered.connect(self.setHapiDir)
+        self.chHapiDir = QtGui.QAction('&Change HITRAN Dir', self)
+        self.chHapiDir.triggered.connect(self.setHapiDir)
         dnldData = QtGui.QAction('&Download HITRAN Data', self)
         dnldData.triggered.connect(self.fetchData)
         saveHData = QtGui.QAction('&Save HITRAN Data', self)
@@ -100,7 +185,7 @@ class AppWindow(QtGui.QMainWindow):
         listHData.triggered.connect(self.listHData)
 
         self.HapiMenu = QtGui.QMenu('&HITRAN Data', self)
-        self.HapiMenu.addAction(chHapiDir)
+        self.HapiMenu.addAction(self.chHapiDir)
         self.HapiMenu.addAction(dnldData)
         self.HapiMenu.addAction(saveHData)
         self.HapiMenu.addAction(listHData)
@@ -120,6 +205,16 @@ class AppWindow(QtGui.QMainWindow):
 
     ##### BLOCK 1: HAPI data management
 
+    def buildMolIdMap(self):
+        # Reverse map of HITRAN molecule name -> molecule number, built
+        # once so fetchData is a dict lookup instead of a 40-probe loop.
+        self.molNameToId = {}
+        for i in range(1, 50):
+            try:
+                self.molNameToId[hapi.moleculeName(i)] = i
+            except:
+                pass
+
     def getLaserConfig(self):
         fileName = self.getFileNameDialog()
         self.laserSpec = specCal.read_config(fileName)
@@ -136,6 +231,15 @@ class AppWindow(QtGui.QMainWindow):
         self.gasList = hapi.getTableList()
         hapi.getTableList()
         self.gasList.remove('sampletab')
+        for gas in self.gasList:
+            if gas not in self.gasNuRange:
+                self.cacheNuRange(gas)
+
+    def cacheNuRange(self, gas):
+        # Cache (nu_min, nu_max) per table so listHData does not rescan
+        # every line of every table each time the dialog opens.
+        nu = hapi.getColumn(gas, 'nu')
+        self.gasNuRange[gas] = (float(min(nu)), float(max(nu)))
 
     def setGasListLabel(self):
         self.getGasList()
@@ -146,14 +250,27 @@ class AppWindow(QtGui.QMainWindow):
 
     def setHapiDir(self):
         dbDir = self.getFileDirDialog()
-        hapi.db_begin_pickle(dbDir)
+        # Load in a worker thread; the menu action stays disabled until
+        # the database is in so concurrent loads cannot be started.
+        self.chHapiDir.setEnabled(False)
+        self.statusBar().showMessage('Loading HITRAN database...')
+        self.hapiLoader = HapiLoader(dbDir, self)
+        self.hapiLoader.loaded.connect(self.onHapiDirLoaded)
+        self.hapiLoader.start()
+
+    def onHapiDirLoaded(self):
         for gas in self.gasList:
             hapi.dropTable(gas)
         self.gasList = []
+        self.gasNuRange = {}
+        self.sigmaCache.clear()
+        specCal.clearCoeffCache()
         self.setGasListLabel()
         self.scrollGasPanel.gasList = self.gasList
         self.scrollGasPanel.updateAll()
         hapi.tableList()
+        self.chHapiDir.setEnabled(True)
+        self.statusBar().showMessage('HITRAN database loaded.')
 
     def fetchData(self):
         inputStr, ok = QtGui.QInputDialog.getText(self, 'Add data',
@@ -164,18 +281,19 @@ class AppWindow(QtGui.QMainWindow):
 
         if ok:
             params = str(inputStr).split(',')
-            for i in range(40):
-                try:
-                    name = hapi.moleculeName(i + 1)
-                    if name == params[0]:
-                        M = i + 1
-                        print M
-                except:
-                    pass
+            M = self.molNameToId.get(params[0])
+            if M is None:
+                self.showError('Unknown gas name: ' + params[0],
+                               'Gas name should be a HITRAN molecule name, '
+                               'e.g. H2O, CO2, NH3.')
+                return
             # try:
             print params[0]
             hapi.fetch_pickle(params[0], M, 1, int(params[1]), int(params[2]))
             nu = hapi.getColumn(params[0], 'nu')
+            self.cacheNuRange(params[0])
+            self.sigmaCache.clear()
+            specCal.clearCoeffCache()
             self.statusBar().showMessage(
                 str(len(nu)) + ' lines' + ' added for ' + params[0] + ' ' + params[
                     1] + '<nu<' + params[2])
@@ -191,6 +309,17 @@ class AppWindow(QtGui.QMainWindow):
 
     ##### End of BLOCK 1.
 
+    def bindFloatEdit(self, lineEdit, attr):
+        # Validate input once at edit time and keep a parsed float shadow
+        # on self, so calPlot does not re-parse (or choke on) the text.
+        lineEdit.setValidator(QtGui.QDoubleValidator(self))
+
+        def update():
+            setattr(self, attr, float(lineEdit.text()))
+
+        lineEdit.editingFinished.connect(update)
+        update()
+
     def setWaveRangeWidget(self):
         # TODO add cm-1, nm, um conversion
         self.waveRangeWidget = QtGui.QWidget(self.mainWidget)
@@ -199,9 +328,11 @@ class AppWindow(QtGui.QMainWindow):
         label2 = QtGui.QLabel('to')
         self.minNu = QtGui.QLineEdit(self.mainWidget)
         self.minNu.setText('1000')
+        self.minNu.setValidator(QtGui.QDoubleValidator(self))
         self.minNu.setMaximumWidth(90)
         self.maxNu = QtGui.QLineEdit(self.mainWidget)
         self.maxNu.setText('1100')
+        self.maxNu.setValidator(QtGui.QDoubleValidator(self))
         self.maxNu.setMaximumWidth(90)
         hbox.addWidget(label1)
         hbox.addWidget(self.minNu)
@@ -210,9 +341,14 @@ class AppWindow(QtGui.QMainWindow):
         labelNumPt = QtGui.QLabel('; # of point: ')
         self.numPt = QtGui.QLineEdit(self.mainWidget)
         self.numPt.setText('1000')
+        self.numPt.setValidator(QtGui.QIntValidator(self))
         self.numPt.setMaximumWidth(70)
         hbox.addWidget(labelNumPt)
         hbox.addWidget(self.numPt)
+        # Single precision is plenty for display resolution; the toggle
+        # restores float64 for users post-processing exported spectra.
+        self.highPrecCheck = QtGui.QCheckBox('High precision')
+        hbox.addWidget(self.highPrecCheck)
         hbox.setAlignment(QtCore.Qt.AlignLeft)
         hbox.setMargin(0)
         self.waveRangeWidget.setLayout(hbox)
@@ -305,6 +441,7 @@ class AppWindow(QtGui.QMainWindow):
         labelWmsMod = QtGui.QLabel('WMS modulation: ')
         labelModUnit = QtGui.QLabel('cm -1')
         self.leWmsMod = QtGui.QLineEdit('0.01')
+        self.bindFloatEdit(self.leWmsMod, 'wmsModVal')
         hbox.addWidget(labelWmsMod)
         hbox.addWidget(self.leWmsMod)
         hbox.addWidget(labelModUnit)
@@ -318,6 +455,7 @@ class AppWindow(QtGui.QMainWindow):
         labelIcut.setMaximumWidth(150)
         self.leICut = QtGui.QLineEdit(self.mainWidget)
         self.leICut.setText('1e-30')
+        self.bindFloatEdit(self.leICut, 'iCutVal')
         self.leICut.setMaximumWidth(90)
         self.leICut.setAlignment(QtCore.Qt.AlignLeft)
         hbox.addWidget(labelIcut)
@@ -354,23 +492,31 @@ class AppWindow(QtGui.QMainWindow):
         self.leftTop.setLayout(vboxTop)
         self.leftBottom.setLayout(vboxBottom)
 
+    def buildCanvasPool(self):
+        # Canvas construction (matplotlib backend + figure setup) is the
+        # expensive part of panel switching, so the four possible panels
+        # are built once and reparented in and out of the grid.
+        self.canvasPool = []
+        for i in range(4):
+            canvas = mplCanvas(self, dpi=self.dpi)
+            canvas.plotButton.clicked.connect(self.calPlot)
+            canvas.exportButton.clicked.connect(self.exportData)
+            canvas.index = i
+            self.canvasPool.append(canvas)
+
     def setCanvas(self):
         numPanel = self.numPanel.checkedId()
         self.grid = QtGui.QGridLayout()
         for canvas in self.canvasList:
-            self.grid.removeWidget(canvas)
-            canvas.deleteLater()
-            canvas.close()
+            # Pull the widget out of the old grid; it stays alive in the
+            # pool for the next layout.
             canvas.setParent(None)
         self.canvasList = []
         self.resultList = []
 
         position = [[1, 0], [2, 0], [1, 1], [2, 1]]
         for i in range(numPanel):
-            canvas = mplCanvas(self, dpi=self.dpi)
-            canvas.plotButton.clicked.connect(self.calPlot)
-            canvas.exportButton.clicked.connect(self.exportData)
-            canvas.index = i
+            canvas = self.canvasPool[i]
             self.canvasList.append(canvas)
             self.resultList.append({})
             self.grid.addWidget(canvas, position[i][0], position[i][1])
@@ -421,65 +567,111 @@ class AppWindow(QtGui.QMainWindow):
         errBox.setWindowTitle('Error message')
         errBox.setStandardButtons(QtGui.QMessageBox.Ok)
 
+    def getNu(self):
+        # Panels usually share one grid; rebuild only when the range or
+        # point count text actually changes.
+        key = (str(self.minNu.text()), str(self.maxNu.text()),
+               str(self.numPt.text()), self.highPrecCheck.isChecked())
+        nu = self.nuCache.get(key)
+        if nu is None:
+            dtype = np.float64 if key[3] else np.float32
+            nu = np.linspace(float(key[0]), float(key[1]), int(key[2]),
+                             dtype=dtype)
+            self.nuCache = {key: nu}
+        return nu
+
     def calPlot(self):
         canvas = self.sender().parent()
         print canvas.index
-        nuMin = float(self.minNu.text())
-        nuMax = float(self.maxNu.text())
-        numPt = int(self.numPt.text())
-        nu = np.linspace(nuMin, nuMax, numPt)
-        iCut = float(self.leICut.text())
+        nu = self.getNu()
+        nuMin = nu[0]
+        nuMax = nu[-1]
+        iCut = self.iCutVal
         gasParamsList = self.scrollGasPanel.getGasInfo()
-        profile = self.comboLineShape.currentText()
-        mode = self.comboWhatPlot.currentText()
+        profile = str(self.comboLineShape.currentText())
+        mode = str(self.comboWhatPlot.currentText())
         self.statusBar().showMessage('Calculating...')
         if self.specChecks.checkedId() == 1:
-            dasResults = specCal.calDas(gasParamsList, nu, profile, mode, iCut=iCut)
-            if type(dasResults) is str:
-                errorMessage = QtGui.QMessageBox()
-                errorMessage.setText(dasResults)
-                errorMessage.exec_()
-                self.statusBar().showMessage(dasResults)
-            else:
-                specCal.plotDas(canvas.axes, dasResults, mode,
-                                showTotal=self.plotTotalCheck.isChecked())
-                self.statusBar().showMessage('Done.')
-            self.resultList[canvas.index] = dasResults
-
+            kind = 'das'
+            func = specCal.calDas
+            args = (gasParamsList, nu, profile, mode)
+            kwargs = {'iCut': iCut, 'coeffCache': self.sigmaCache}
         else:
+            kind = 'wms'
             method = self.wmsMethod.currentText()
-            dNu = float(self.leWmsMod.text())
+            dNu = self.wmsModVal
             nf = int(mode.replace('f', ''))
             if method == 'Theoretical':
-                wmsResults = specCal.calWms(gasParamsList, nu, profile, nf, method,
-                                            dNu=dNu)
+                func = specCal.calWms
+                args = (gasParamsList, nu, profile, nf, 'Theoretical')
+                kwargs = {'dNu': dNu, 'coeffCache': self.sigmaCache}
             else:
                 if self.laserSpec is None:
                     self.showError('No laser configuration.', 'Please go to Laser '
                                                               'config and load a '
                                                               'laser configuration.')
-                    wmsResults = 'No laser configuration.'
-                else:
-                    self.laserSpec['central_wavelength'] = (nuMin + nuMax) / 2.
-                    self.laserSpec['aRamp'] = (nuMax -
-                                               nuMin) / 200 * 1e3 / self.laserSpec[
-                                                  'tRamp']
-                    wmsResults = specCal.calWms(gasParamsList, nu, profile, nf,
-                                                'Simulation with parameters',
-                                                laserSpec=self.laserSpec)
-            if type(wmsResults) is str:
-                errorMessage = QtGui.QMessageBox()
-                errorMessage.setText(wmsResults)
-                errorMessage.exec_()
-                self.statusBar().showMessage(wmsResults)
-            else:
-                self.statusBar().showMessage('Done.')
-                specCal.plotWms(canvas.axes, wmsResults,
-                                showTotal=self.plotTotalCheck.isChecked())
-            self.resultList[canvas.index] = wmsResults
-
-        canvas.figure.tight_layout()
-        canvas.canvas.draw()
+                    self.resultList[canvas.index] = 'No laser configuration.'
+                    return
+                self.laserSpec['central_wavelength'] = (nuMin + nuMax) / 2.
+                self.laserSpec['aRamp'] = (nuMax -
+                                           nuMin) / 200 * 1e3 / self.laserSpec[
+                                              'tRamp']
+                func = specCal.calWms
+                args = (gasParamsList, nu, profile, nf,
+                        'Simulation with parameters')
+                # Snapshot the spec: a later calPlot rewrites
+                # central_wavelength/aRamp above, and the worker must
+                # not see that mid-calculation.
+                kwargs = {'laserSpec': dict(self.laserSpec),
+                          'coeffCache': self.sigmaCache}
+
+        # One in-flight calculation per panel; other panels stay usable
+        # and compute in parallel on the pool.
+        canvas.plotButton.setEnabled(False)
+        runnable = CalcRunnable(canvas.index, func, args, kwargs, kind, mode)
+        runnable.signals.done.connect(self.onCalcDone)
+        QtCore.QThreadPool.globalInstance().start(runnable)
+
+    def onCalcDone(self, index, results, kind, mode):
+        canvas = self.canvasPool[index]
+        canvas.plotButton.setEnabled(True)
+        if index >= len(self.resultList):
+            # Panel count was reduced while this calculation ran; the
+            # panel is gone, so drop the result.
+            return
+        self.resultList[index] = results
+        if type(results) is str:
+            errorMessage = QtGui.QMessageBox()
+            errorMessage.setText(results)
+            errorMessage.exec_()
+            self.statusBar().showMessage(results)
+            return
+        if kind == 'das':
+            specCal.plotDas(canvas.axes, results, mode,
+                            showTotal=self.plotTotalCheck.isChecked(),
+                            lines=canvas.lines)
+        else:
+            specCal.plotWms(canvas.axes, results,
+                            showTotal=self.plotTotalCheck.isChecked(),
+                            lines=canvas.lines)
+        self.statusBar().showMessage('Done.')
+
+        for line in canvas.lines.values():
+            line.set_animated(True)
+        lims = (canvas.axes.get_xlim(), canvas.axes.get_ylim())
+        # The legend is baked into the cached background, so changed
+        # labels need a full draw even when the limits held still.
+        labels = tuple(sorted((str(key), line.get_label())
+                              for key, line in canvas.lines.items()))
+        if (canvas.background is not None and lims == canvas.bgLims
+                and labels == canvas.bgLabels):
+            # Axes decorations are unchanged; composite only the lines.
+            canvas.blitLines()
+        else:
+            canvas.bgLims = lims
+            canvas.bgLabels = labels
+            canvas.figure.tight_layout()
+            canvas.canvas.draw()
         canvas.canvas.updateGeometry()
 
     def exportData(self):
@@ -507,8 +699,8 @@ class AppWindow(QtGui.QMainWindow):
         closeButton.clicked.connect(dialog.close)
         vboxDialog = QtGui.QVBoxLayout()
         for gas in self.gasList:
-            nu = np.array(hapi.getColumn(gas, 'nu'))
-            gasInfo = gas + ' :' + str(nu.min()) + ' to ' + str(nu.max()) + ' cm -1'
+            nuMin, nuMax = self.gasNuRange[gas]
+            gasInfo = gas + ' :' + str(nuMin) + ' to ' + str(nuMax) + ' cm -1'
             labelGasInfo = QtGui.QLabel(gasInfo)
             vboxScroll.addWidget(labelGasInfo)
         vboxScroll.setAlignment(QtCore.Qt.AlignTop)
@@ -531,7 +723,8 @@ def resource_path(relative):
 def main():
     filename = 'defaultSettings.txt'
     app = QtGui.QApplication(sys.argv)
-    appWindow = AppWindow()
+    scrsz = QtGui.QDesktopWidget().availableGeometry().getRect()
+    appWindow = AppWindow(scrsz=scrsz)
     appWindow.show()
     sys.exit(app.exec_())
 
@@ -1,3 +1,4 @@
+# -*- coding: utf-8 -*-
 """
 Notes
 -----
@@ -29,61 +30,204 @@ Edited Dates
     Docstrings added for all functions.
 """
 
+from __future__ import print_function, division
+
 import hapi
+import lineShape
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import ticker
-from scipy.integrate import simps, romb
-from scipy.signal import butter, lfilter
-import csv
+from scipy.signal import butter, sosfilt, firwin, fftconvolve
+import itertools
+import collections
+import sys
+
+# Temp table names are made unique per calDas call so concurrent
+# calculations (e.g. panels running on a thread pool) don't collide.
+_tmpCount = itertools.count()
+
+# Default cross-section cache shared by all calDas calls (scripts get
+# caching for free; the GUI passes its own dict so it controls
+# invalidation). Bounded: oldest entry is dropped once full.
+_coeffCache = collections.OrderedDict()
+_coeffCacheMax = 64
+
+
+_sosCache = {}
+
+
+def _butterSos(order, wn):
+    """
+    Low-pass Butterworth design in second-order sections, cached per
+    (order, wn) so repeated WMS demodulations skip the filter design.
+
+    Parameters
+    ----------
+    order: int
+        Filter order.
+    wn: float
+        Normalized cut frequency.
+
+    Returns
+    -------
+    sos: array
+        Second-order section coefficients for sosfilt.
+    """
+    key = (order, wn)
+    sos = _sosCache.get(key)
+    if sos is None:
+        sos = butter(order, wn, 'low', output='sos')
+        _sosCache[key] = sos
+    return sos
+
+
+_firCache = {}
+
+
+def _firTaps(numtaps, wn):
+    """
+    Windowed-sinc low-pass design, cached per (numtaps, wn) like the
+    Butterworth designs above.
+
+    Parameters
+    ----------
+    numtaps: int
+        Filter length.
+    wn: float
+        Cut frequency normalized to Nyquist.
+
+    Returns
+    -------
+    taps: array
+        FIR coefficients.
+    """
+    key = (numtaps, wn)
+    taps = _firCache.get(key)
+    if taps is None:
+        taps = firwin(numtaps, wn)
+        _firCache[key] = taps
+    return taps
+
+
+def clearCoeffCache():
+    """
+    Drop all cached cross-sections and line selections. Call after
+    re-fetching HITRAN data, since cached entries are keyed by
+    gas/environment, not by the underlying line table contents.
+
+    Returns
+    -------
+
+    """
+    _coeffCache.clear()
+    clearTableCache()
+
+
+_tableCache = {}
+
+
+def _selectLines(gas, nuMin, nuMax, iCut, wingSpan):
+    """
+    Return the name of a HAPI table holding the lines of gas within
+    wingSpan of [nuMin, nuMax] above the intensity cut. Selections
+    depend only on the line list — not on temperature or pressure — so
+    they are cached across calDas calls and reused by every environment
+    sharing the window (see clearTableCache).
+
+    Parameters
+    ----------
+    gas: str
+        Source HAPI table name.
+    nuMin: float
+        Lower edge of the wavenumber grid in cm-1.
+    nuMax: float
+        Upper edge of the wavenumber grid in cm-1.
+    iCut: float
+        Intensity cut threshold.
+    wingSpan: float
+        Wing margin in cm-1 on each side of the grid.
+
+    Returns
+    -------
+    name: str
+        Name of the selected (possibly cached) HAPI table.
+    """
+    key = (gas, round(nuMin, 4), round(nuMax, 4), iCut, wingSpan)
+    name = _tableCache.get(key)
+    if name is None or name not in hapi.tableList():
+        name = 'tmp%d' % next(_tmpCount)
+        Cond = ('AND', ('BETWEEN', 'nu', nuMin - wingSpan, nuMax + wingSpan),
+                ('>=', 'sw', iCut))
+        hapi.select(gas, Conditions=Cond, DestinationTableName=name)
+        _tableCache[key] = name
+    return name
+
+
+def clearTableCache():
+    """
+    Drop every cached line selection and its backing HAPI table.
+
+    Returns
+    -------
+
+    """
+    for name in _tableCache.values():
+        if name in hapi.tableList():
+            hapi.dropTable(name)
+    _tableCache.clear()
 
 kb = 1.38064852e-23  # Boltzmann constant, m^2 kg s^-2 K^-1
 nA = 6.022e23  # Avogadro's number molec/mol-1
 R = 8.314  # Universal gas constant
 
+_nDenConst = 1.013e5 * 1e-6 / kb  # molec/cm^3 per (atm/K)
+_mDenConst = 1.013e5 / R  # mol/m^3 per (atm/K)
+
 
 def mixRatio2numDen(c, p, T):
     """
-    Convert mixing ratio to number density.
+    Convert mixing ratio to number density. Arguments broadcast, so
+    arrays of (c, p, T) triples work as well as scalars.
     Parameters
     ----------
-    c: float
+    c: float or array
         Volume mixing ratio.
-    p: float
+    p: float or array
         Pressure in atm.
-    T: float
+    T: float or array
         Temperature in K.
 
     Returns
     -------
-    n: float
+    n: float or array
         Number density in molec/cm^3
 
     """
-    n = p * 1.013e5 / kb / T * 1e-6 * c
+    n = _nDenConst * p * c / T
     return n
 
 
 def mixRatio2molDen(c, p, T):
     """
-    Convert mixing ratio to molar density.
+    Convert mixing ratio to molar density. Arguments broadcast, so
+    arrays of (c, p, T) triples work as well as scalars.
 
     Parameters
     ----------
-    c: float
+    c: float or array
         Volume mixing ratio.
-    p: float
+    p: float or array
         Pressure in atm.
-    T: float
+    T: float or array
         Temperature in K.
 
     Returns
     -------
-    m: float
+    m: float or array
         Mol density in mol/m^3.
 
     """
-    m = p * 1.013e5 / R / T * c
+    m = _mDenConst * p * c / T
     return m
 
 
@@ -105,21 +249,83 @@ def read_config(config_name):
 
     """
 
-    print "\nReading configuration from " + config_name + ":\n"
+    print("\nReading configuration from " + config_name + ":\n")
 
     config = {}
 
     with open(config_name) as f:
         for line in f:
             key, value = line.split(': ')
-            config[key] = float(value[:-1])
-            print key + ': ' + value[:-1]
+            config[key] = float(value.strip())
+            print(key + ': ' + value.strip())
 
     return config
 
 
+def calVoigtCoeff(tableName, nu, t, p, iCut=1e-30):
+    """
+    Calculate the Voigt absorption cross-section for all lines of a HAPI
+    table on the given grid. Mirrors hapi.absorptionCoefficient_Voigt
+    for the default air-broadened case, but pulls the line parameters
+    into contiguous arrays and hands the per-line accumulation to the
+    lineShape kernel instead of looping over lines in Python.
+
+    Parameters
+    ----------
+    tableName: str
+        Name of the HAPI table holding the selected lines.
+    nu: array
+        Wavenumber grid in cm-1 (ascending).
+    t: float
+        Temperature in K.
+    p: float
+        Pressure in atm.
+    iCut: float
+        Intensity cut threshold, applied at temperature t.
+
+    Returns
+    -------
+    coeff: array
+        Absorption cross-section in cm^2/molec on nu.
+    """
+    tRef = 296.
+    nu0 = np.array(hapi.getColumn(tableName, 'nu'))
+    sw = np.array(hapi.getColumn(tableName, 'sw'))
+    elower = np.array(hapi.getColumn(tableName, 'elower'))
+    molecId = np.array(hapi.getColumn(tableName, 'molec_id'))
+    isoId = np.array(hapi.getColumn(tableName, 'local_iso_id'))
+    gammaAir = np.array(hapi.getColumn(tableName, 'gamma_air'))
+    nAir = np.array(hapi.getColumn(tableName, 'n_air'))
+    deltaAir = np.array(hapi.getColumn(tableName, 'delta_air'))
+
+    nu = np.asarray(nu)
+    coeff = np.zeros(len(nu), dtype=nu.dtype)  # FP32 grid -> FP32 Voigt
+    cMassMol = 1.66053873e-27  # same constant hapi uses
+    for key in set(zip(molecId, isoId)):
+        M, I = int(key[0]), int(key[1])
+        mask = (molecId == M) & (isoId == I)
+        sigmaT = hapi.PYTIPS(M, I, t)
+        sigmaTRef = hapi.PYTIPS(M, I, tRef)
+        lineS = hapi.EnvironmentDependency_Intensity(
+            sw[mask], t, tRef, sigmaT, sigmaTRef, elower[mask], nu0[mask])
+        keep = lineS >= iCut
+        if not np.any(keep):
+            continue
+        center = nu0[mask][keep]
+        m = hapi.molecularMass(M, I) * cMassMol * 1000
+        gammaD = np.sqrt(
+            2 * hapi.cBolts * t * np.log(2) / m / hapi.cc ** 2) * center
+        gamma0 = hapi.EnvironmentDependency_Gamma0(
+            gammaAir[mask][keep], t, tRef, p, 1., nAir[mask][keep])
+        lineShape.voigtAccumulate(nu, center + deltaAir[mask][keep] * p,
+                                  lineS[keep], gammaD, gamma0, coeff,
+                                  iCut=iCut)
+    return coeff
+
+
 def calDas(gasList, nu, profile, mode, iCut=1e-30, xi_to_nden=True,
-           mden_to_nden=False, etalonCoeff=None):
+           mden_to_nden=False, etalonCoeff=None, coeffCache=None,
+           wingSpan=25.):
     """
     Calculate direction absorption spectrum.
     Parameters
@@ -142,6 +348,17 @@ def calDas(gasList, nu, profile, mode, iCut=1e-30, xi_to_nden=True,
         If True, will convert given molar density to number density.
     etalonCoeff: list of dict
         Results from generateEtalons, containing coefficients for etalon calculation.
+    coeffCache: dict, default=None
+        Bare cross-sections are cached per (gas, t, p, profile, iCut,
+        wingSpan, nu signature), so recalculations that only change
+        concentration or path length skip the line shape evaluation
+        entirely. When None, a bounded module-level cache is used (see
+        clearCoeffCache); pass a dict to own invalidation yourself.
+    wingSpan: float
+        Wing margin in cm-1 around the requested grid. Only lines with
+        centers inside [nu.min() - wingSpan, nu.max() + wingSpan] are
+        evaluated; lines further out contribute negligibly, so cost
+        scales with lines in window rather than database size.
 
     Returns
     -------
@@ -150,6 +367,11 @@ def calDas(gasList, nu, profile, mode, iCut=1e-30, xi_to_nden=True,
         'nu' (wavelength array cm^-1), 'coeff' (spectrum coeff).
     """
     results = []
+    # Entries sharing (gas, T, P) within one call reuse a single
+    # cross-section; only n and l differ between such entries.
+    callCache = {}
+    if coeffCache is None:
+        coeffCache = _coeffCache
     for idx, gasParams in enumerate(gasList):
         if gasParams['gas'] not in hapi.tableList():
             return str('Cannot find specified gas.')
@@ -160,8 +382,6 @@ def calDas(gasList, nu, profile, mode, iCut=1e-30, xi_to_nden=True,
                     np.max(nu) < np.min(nuInTable) - 1):
             return str(
                 'Cannot find lines within specified wavenumber range, please download data.')
-        Cond = ('AND', ('BETWEEN', 'nu', np.min(nu), np.max(nu)), ('>=', 'sw', iCut))
-        hapi.select(gasParams['gas'], Conditions=Cond, DestinationTableName='tmp')
         p = gasParams['p'] / 1.013e3
         t = float(gasParams['t'])
 
@@ -171,36 +391,54 @@ def calDas(gasList, nu, profile, mode, iCut=1e-30, xi_to_nden=True,
         if mden_to_nden:
             n = nA * gasParams['c'] * 1e-6
 
-        if profile == 'Voigt':
-            nu, coeff = hapi.absorptionCoefficient_Voigt(SourceTables='tmp',
-                                                         OmegaGrid=nu,
-                                                         Environment={'T': t,
-                                                                      'p': p})
-        elif profile == 'HT':
-            nu, coeff = hapi.absorptionCoefficient_HT(SourceTables='tmp',
-                                                      OmegaGrid=nu,
-                                                      Environment={'T': t, 'p': p},
-                                                      IntensityThreshold=iCut)
-        elif profile == 'Doppler':
-            nu, coeff = hapi.absorptionCoefficient_Doppler(SourceTables='tmp',
-                                                           OmegaGrid=nu,
-                                                           Environment={'T': t,
-                                                                        'p': p},
-                                                           IntensityThreshold=iCut)
-        elif profile == 'Lorentz':
-            nu, coeff = hapi.absorptionCoefficient_Lorentz(SourceTables='tmp',
-                                                           OmegaGrid=nu,
-                                                           Environment={'T': t,
-                                                                        'p': p},
-                                                           IntensityThreshold=iCut)
-        else:
-            raise Exception('No suitable profile.')
+        cacheKey = (gasParams['gas'], t, p, profile, iCut, wingSpan,
+                    float(nu[0]), float(nu[-1]), len(nu), str(nu.dtype))
+        coeff = callCache.get(cacheKey)
+        if coeff is None:
+            coeff = coeffCache.get(cacheKey)
+
+        if coeff is None:
+            # The selection keeps a wingSpan margin on each side (lines
+            # just outside the grid still contribute) and is reused for
+            # every environment sharing the same gas and window.
+            tmpTable = _selectLines(gasParams['gas'], float(np.min(nu)),
+                                    float(np.max(nu)), iCut, wingSpan)
+            if profile == 'Voigt':
+                coeff = calVoigtCoeff(tmpTable, nu, t, p, iCut=iCut)
+            elif profile == 'HT':
+                nu, coeff = hapi.absorptionCoefficient_HT(SourceTables=tmpTable,
+                                                          OmegaGrid=nu,
+                                                          Environment={'T': t,
+                                                                       'p': p},
+                                                          IntensityThreshold=iCut)
+            elif profile == 'Doppler':
+                nu, coeff = hapi.absorptionCoefficient_Doppler(SourceTables=tmpTable,
+                                                               OmegaGrid=nu,
+                                                               Environment={'T': t,
+                                                                            'p': p},
+                                                               IntensityThreshold=iCut)
+            elif profile == 'Lorentz':
+                nu, coeff = hapi.absorptionCoefficient_Lorentz(SourceTables=tmpTable,
+                                                               OmegaGrid=nu,
+                                                               Environment={'T': t,
+                                                                            'p': p},
+                                                               IntensityThreshold=iCut)
+            else:
+                raise Exception('No suitable profile.')
+            callCache[cacheKey] = coeff
+            if coeffCache is _coeffCache and len(_coeffCache) >= _coeffCacheMax:
+                _coeffCache.popitem(last=False)
+            coeffCache[cacheKey] = coeff
+
         if mode == 'Absorbance':
-            coeff = coeff * n * gasParams['l']
+            coeff = coeff * (n * gasParams['l'])
         elif mode == 'Transmission':
-            coeff = coeff * n * gasParams['l']
-            coeff = np.exp(-coeff)
-        hapi.dropTable('tmp')
+            # The first multiply allocates (the cached cross-section
+            # must stay untouched); negate and exponentiate run in
+            # place on the copy, so the pipeline makes one array.
+            coeff = coeff * (n * gasParams['l'])
+            np.negative(coeff, out=coeff)
+            np.exp(coeff, out=coeff)
         result = dict()
         result['gasParams'] = gasParams
         result['nu'] = nu
@@ -209,7 +447,50 @@ def calDas(gasList, nu, profile, mode, iCut=1e-30, xi_to_nden=True,
     return results
 
 
-def plotDas(ax, results, mode, showTotal=True):
+def canReuseLines(ax, lines, keys):
+    """
+    Check whether a persistent Line2D dict still matches the curve set to
+    be plotted, so the plot routines can update data in place instead of
+    rebuilding artists.
+
+    Parameters
+    ----------
+    ax: object
+        Axis object for plotting.
+    lines: dict or None
+        Persistent Line2D handles keyed by curve (index or 'total').
+    keys: list
+        Keys expected for the current plot.
+
+    Returns
+    -------
+    reuse: bool
+        True if every expected line exists and still lives on ax.
+    """
+    if lines is None:
+        return False
+    if set(lines.keys()) != set(keys):
+        return False
+    for line in lines.values():
+        if line.axes is not ax:
+            return False
+    return True
+
+
+def setPlotLine(ax, lines, reuse, key, nu, y, label):
+    """
+    Update an existing Line2D in place or create it on first plot.
+    """
+    if reuse:
+        lines[key].set_data(nu, y)
+        lines[key].set_label(label)
+    else:
+        line = ax.plot(nu, y, label=label)[0]
+        if lines is not None:
+            lines[key] = line
+
+
+def plotDas(ax, results, mode, showTotal=True, lines=None):
     """
     Plot direction absorption spectroscopy results from calDas.
 
@@ -224,46 +505,50 @@ def plotDas(ax, results, mode, showTotal=True):
         Choose from 'Absorbance', 'Transmission', 'Absorb spectrum'.
     showTotal: bool
         If True, plot the sum of given spectra.
+    lines: dict, default=None
+        Persistent Line2D handles for the axis. When given and the curve
+        set is unchanged, data is swapped via set_data instead of
+        recreating every artist.
 
     Returns
     -------
 
     """
-    sumAbsorp = np.zeros(results[0]['nu'].shape)
-    sumTrans = np.copy(sumAbsorp) + 1
-
+    keys = list(range(len(results)))
+    if showTotal and mode in ('Absorbance', 'Transmission'):
+        keys.append('total')
+    reuse = canReuseLines(ax, lines, keys)
+    if not reuse:
+        ax.clear()
+        if lines is not None:
+            lines.clear()
+
+    # One (nGas, nNu) block; totals come from single reductions over
+    # the gas axis instead of running accumulators in the plot loop.
+    spec = np.stack([result['spectrum'] for result in results])
     for idx, result in enumerate(results):
-        # resuls is a dict containing gasParameter, nu, and spectrum
-        gasParams = result['gasParams']
+        # spectrum could be absorption spectrum, absorbance, or
+        # transmittance
         nu = result['nu']
-        spectrum = result[
-            'spectrum']  # spectrum could be absorption spectrum, absorbance,
-        # or transmittance
-        if mode == 'Absorp coeff':
-            ax.plot(nu, spectrum, label=strGasParams(gasParams))
-        elif mode == 'Absorbance':
-            ax.plot(nu, spectrum, label=strGasParams(gasParams))
-            sumAbsorp = sumAbsorp + spectrum
-            # print(strGasParams(gasParams))
-        elif mode == 'Transmission':
-            ax.plot(nu, spectrum, label=strGasParams(gasParams))
-            sumTrans = sumTrans * spectrum
-        if idx == 0:
-            ax.hold(True)
+        setPlotLine(ax, lines, reuse, idx, nu, spec[idx],
+                    strGasParams(result['gasParams']))
     if mode == 'Absorbance':
         if showTotal:
-            ax.plot(nu, sumAbsorp, label='Total')
+            setPlotLine(ax, lines, reuse, 'total', nu, spec.sum(0), 'Total')
         ax.set_ylabel('Absorbance')
         leg = ax.legend(fontsize=11, loc=2, frameon=False)
     elif mode == 'Transmission':
         if showTotal:
-            ax.plot(nu, sumTrans, label='Total')
+            setPlotLine(ax, lines, reuse, 'total', nu, spec.prod(0), 'Total')
         ax.set_ylabel('Transmission')
         leg = ax.legend(fontsize=11, loc=3, frameon=False)
     elif mode == 'Absorp coeff':
         if showTotal:
             ax.set_ylabel('Absorp coeff')
         leg = ax.legend(fontsize=11, loc=2, frameon=False)
+    if reuse:
+        ax.relim()
+        ax.autoscale_view()
     formatter = ticker.ScalarFormatter(useMathText=True)
     if leg:
         leg.draggable()
@@ -273,13 +558,12 @@ def plotDas(ax, results, mode, showTotal=True):
     formatter.set_useOffset(False)
     ax.yaxis.set_major_formatter(formatter)
     ax.xaxis.set_major_formatter(formatter)
-    ax.hold(False)
-    plt.tight_layout()
     return 0
 
 
 def calWms(gasList, nu, profile, nf, method='Theoretical', laserSpec=None, dNu=None,
-           iCut=1e-30, diag=False, xi_to_nden=True, mden_to_nden=False):
+           iCut=1e-30, diag=False, xi_to_nden=True, mden_to_nden=False,
+           coeffCache=None, filter_kind='iir'):
     """
     Calculate spectra using wavelength modulation spectroscopy. This function
     calls calDas. Two methods are provided. The 'theoretical' method is based on
@@ -315,6 +599,13 @@ def calWms(gasList, nu, profile, nf, method='Theoretical', laserSpec=None, dNu=N
         Intensity cut threshold.
     diag: bool
         If true, plot figures for diagnostics.
+    filter_kind: str, default='iir'
+        Low-pass for the 'Simulation with parameters' demodulation:
+        'iir' keeps the 4th-order Butterworth, 'fir' convolves with a
+        201-tap windowed sinc instead. The symmetric FIR kernel has
+        exactly linear phase, so the demodulated harmonic comes out
+        with no phase distortion to compensate for via the phase
+        setting.
 
     Returns
     -------
@@ -323,33 +614,66 @@ def calWms(gasList, nu, profile, nf, method='Theoretical', laserSpec=None, dNu=N
         gasList), nu (wavelength number cm^-1), spectrum (wms spectrum),
         nf (nth harmonics), modDepth (modulation depth).
 
+    Notes
+    -----
+    The 'Simulation with parameters' demodulation runs in single
+    precision: the carriers, intensity and filtered signals are
+    float32, which is ample for detector-limited signals (< 24
+    effective bits) and roughly halves the memory traffic of the hot
+    loop. The IIR coefficients themselves stay float64 — the filter
+    poles sit close to the unit circle, where float32 coefficient
+    quantization visibly distorts the harmonic. Harmonic spectra from
+    this branch therefore come back as float32 arrays.
+
     """
     maxNu = nu.max()
     minNu = nu.min()
     if method == 'Theoretical':
         hdNu = np.linspace(minNu, maxNu, int((maxNu - minNu) / dNu * 1024) + 1)
 
-        dasResults = calDas(gasList, hdNu, profile, 'Transmission', iCut)
+        dasResults = calDas(gasList, hdNu, profile, 'Transmission', iCut,
+                            coeffCache=coeffCache)
         if type(dasResults) is str:
             return dasResults
         wmsResults = []
-        for result in dasResults:
-            coeff = result['spectrum']
-            Hnf = []
-            for iNu in nu:
-                u, du = np.linspace(-np.pi, np.pi, 2 ** 10 + 1, retstep=True)
-
-                nuMod = iNu + dNu * np.cos(u)
-                coeffMod = np.interp(nuMod, hdNu, coeff)
-                integrateSample = coeffMod * np.cos(nf * u)
-                Hnf.append(1. / np.pi * romb(np.array(integrateSample), dx=du))
-
-            Hnf = np.array(Hnf)
-
+        # The nth harmonic is (1/pi) * integral of coeff(nu + dNu*cos(u))
+        # * cos(nf*u) over one modulation period, i.e. the nth Fourier
+        # cosine coefficient of the modulated spectrum. Evaluate it for
+        # every grid point at once: broadcast the modulated wavenumbers
+        # to a (len(nu), len(u)) matrix, gather from the uniform hdNu
+        # grid by index arithmetic (cheaper than np.interp's binary
+        # search), and take the coefficient as a periodic-trapezoid dot
+        # product with the precomputed cos(nf*u) vector — for a smooth
+        # periodic integrand this equals the DFT bin, and only the one
+        # harmonic is needed. The duplicated endpoint is dropped so the
+        # samples span exactly one period.
+        M = 2 ** 10
+        u = np.linspace(-np.pi, np.pi, M + 1)[:-1]
+        cosNfu = np.cos(nf * u)
+        cosU = np.cos(u)
+        step = hdNu[1] - hdNu[0]
+        # Blocks of grid points bound the (rows, M) broadcast
+        # temporaries to a few MB regardless of the requested numPt;
+        # each block still reduces with one dot product per gas.
+        blockRows = 4096
+        HnfList = [np.empty(len(nu)) for result in dasResults]
+        for lo in range(0, len(nu), blockRows):
+            hi = min(lo + blockRows, len(nu))
+            nuMod = nu[lo:hi, None] + dNu * cosU[None, :]
+            pos = (nuMod - hdNu[0]) / step
+            i0 = np.clip(pos.astype(np.intp), 0, len(hdNu) - 2)
+            # Clamp like np.interp: modulation can push past the grid
+            # edge
+            frac = np.clip(pos - i0, 0., 1.)
+            for idx, result in enumerate(dasResults):
+                coeff = result['spectrum']
+                coeffMod = coeff[i0] * (1. - frac) + coeff[i0 + 1] * frac
+                HnfList[idx][lo:hi] = (2. / M) * np.dot(coeffMod, cosNfu)
+        for idx, result in enumerate(dasResults):
             wmsResult = dict()
             wmsResult['gasParams'] = result['gasParams']
             wmsResult['nu'] = nu
-            wmsResult['spectrum'] = Hnf
+            wmsResult['spectrum'] = HnfList[idx]
             wmsResult['nf'] = nf
             wmsResult['modDepth'] = dNu
 
@@ -388,26 +712,68 @@ def calWms(gasList, nu, profile, nf, method='Theoretical', laserSpec=None, dNu=N
         intensity = (currRamp + currMod) * c2p + laserDC
         intensity[intensity < 0] = 0
 
-        b, a = butter(4, fCut / fS, 'low')
+        sos = _butterSos(4, fCut / fS)
+        # Everything below is the same for every gas in the list:
+        # carriers, the reversed sweep (a view, not a copy), and the
+        # scratch buffers the per-gas products are written into. The
+        # demodulation itself runs in single precision — real detector
+        # data carries far fewer than 24 significant bits, and float32
+        # halves the bandwidth through the carriers and products. The
+        # SOS coefficients stay float64: the poles are nearly on the
+        # unit circle, so quantizing them to float32 distorts the
+        # harmonic (see the precision note in the docstring).
+        cosCarrier = np.cos(
+            2. * nf * np.pi * fMod * ts + phase).astype(np.float32)
+        sinCarrier = np.sin(2. * nf * np.pi * fMod * ts).astype(np.float32)
+        intensity = intensity.astype(np.float32)
+        if filter_kind == 'fir':
+            # Same normalized cut as the butter design above, so both
+            # filter kinds share one demodulation bandwidth (the
+            # historical fCut/fS convention, i.e. fCut/2 against
+            # Nyquist).
+            taps = _firTaps(201, fCut / fS).astype(np.float32)
+        nuTotalFlipped = nuTotal[::-1]
+        S = np.empty_like(intensity)
+        tmp = np.empty_like(intensity)
+        # The nu grid is normally uniform; gather indices then replace
+        # np.interp's per-sample binary search with index arithmetic,
+        # computed once since the sweep is gas independent (clamped at
+        # the edges like np.interp).
+        uniformGrid = np.allclose(np.diff(nu), nu[1] - nu[0])
+        if uniformGrid:
+            pos = (nuTotalFlipped - nu[0]) / (nu[1] - nu[0])
+            i0 = np.clip(pos.astype(np.intp), 0, len(nu) - 2)
+            frac = np.clip(pos - i0, 0., 1.)
 
         wmsResults = []
         dasResults = calDas(gasList, nu, profile, 'Transmission', iCut,
-                            xi_to_nden=xi_to_nden, mden_to_nden=mden_to_nden)
+                            xi_to_nden=xi_to_nden, mden_to_nden=mden_to_nden,
+                            coeffCache=coeffCache)
 
         if type(dasResults) is str:
             return dasResults
 
         for dasResult in dasResults:
             coeff = dasResult['spectrum']
-            modCoeff = np.interp(np.flipud(nuTotal), nu, coeff)
+            if uniformGrid:
+                modCoeff = coeff[i0] * (1. - frac) + coeff[i0 + 1] * frac
+            else:
+                modCoeff = np.interp(nuTotalFlipped, nu, coeff)
 
-            S = intensity * modCoeff
+            np.multiply(intensity, modCoeff, out=S)
             if diag:
                 plt.plot(S)
                 plt.show()
-            # plt.plot(S * np.cos(2. * nf * np.pi * fMod * ts + phase))
-            y = lfilter(b, a, S * np.cos(2. * nf * np.pi * fMod * ts + phase))
-            x = lfilter(b, a, S * np.sin(2. * nf * np.pi * fMod * ts))
+            np.multiply(S, cosCarrier, out=tmp)
+            if filter_kind == 'fir':
+                y = fftconvolve(tmp, taps, mode='same')
+            else:
+                y = sosfilt(sos, tmp)
+            np.multiply(S, sinCarrier, out=tmp)
+            if filter_kind == 'fir':
+                x = fftconvolve(tmp, taps, mode='same')
+            else:
+                x = sosfilt(sos, tmp)
             wmsResult = dict()
             wmsResult['gasParams'] = dasResult['gasParams']
             wmsResult['nu'] = nuRamp
@@ -446,13 +812,42 @@ def IIRFilter(signal, fS, fMod, nf, fCut, phase):
     """
     nS = len(signal)
     tS = np.arange(nS) / fS
-    b, a = butter(4, fCut / fS, 'low')
-    y = lfilter(b, a, signal * np.cos(2. * nf * np.pi * fMod * tS + np.deg2rad(phase)
-                                      ))
+    sos = _butterSos(4, fCut / fS)
+    y = sosfilt(sos, signal * np.cos(2. * nf * np.pi * fMod * tS + np.deg2rad(phase)
+                                     ))
 
     return y
 
 
+_pthKernel = None  # chosen (and possibly jit compiled) on first call
+
+
+def _pth(signal, startIdx, endIdx, hWindow):
+    """
+    Peak-to-trough kernel: small argmax/argmin/mean passes over
+    overlapping windows, njit compiled when numba is available since
+    the per-op overhead dominates at these slice sizes.
+    """
+    tmpSignal = signal[startIdx:endIdx]
+
+    peakIdx = np.argmax(tmpSignal)
+
+    lTroughIdx = np.argmin(tmpSignal[:peakIdx])  # Left trough index
+    rTroughIdx = np.argmin(tmpSignal[peakIdx:])  # Right trough index
+
+    return np.mean(tmpSignal[peakIdx - hWindow:peakIdx + hWindow]) - 0.5 * (
+        np.mean(tmpSignal[lTroughIdx - hWindow:lTroughIdx + hWindow]) + np.mean(
+            tmpSignal[rTroughIdx - hWindow:rTroughIdx + hWindow]))
+
+
+def _buildPthKernel():
+    try:
+        from numba import njit
+    except ImportError:
+        return _pth
+    return njit(cache=True, nogil=True)(_pth)
+
+
 def peakTroughHeight(signal, startIdx, endIdx, twoSideTrough=True, avgWindow=50):
     """
     Calculate peak to trough height.
@@ -471,20 +866,14 @@ def peakTroughHeight(signal, startIdx, endIdx, twoSideTrough=True, avgWindow=50)
         Peak to trough height.
 
     """
-    tmpSignal = signal[startIdx:endIdx]
-
-    peakIdx = np.argmax(tmpSignal)
-
-    lTroughIdx = np.argmin(tmpSignal[:peakIdx])  # Left trough index
-    rTroughIdx = np.argmin(tmpSignal[peakIdx:])  # Right trough index
-
-    hWindow = int(avgWindow / 2)
-    return np.mean(tmpSignal[peakIdx - hWindow:peakIdx + hWindow]) - 0.5 * (
-        np.mean(tmpSignal[lTroughIdx - hWindow:lTroughIdx + hWindow]) + np.mean(
-            tmpSignal[rTroughIdx - hWindow:rTroughIdx + hWindow]))
+    global _pthKernel
+    if _pthKernel is None:
+        _pthKernel = _buildPthKernel()
+    return _pthKernel(np.ascontiguousarray(signal, dtype=np.float64),
+                      int(startIdx), int(endIdx), int(avgWindow / 2))
 
 
-def plotWms(ax, results, showTotal=True):
+def plotWms(ax, results, showTotal=True, lines=None):
     """
     Plot results from calWMS.
 
@@ -496,22 +885,31 @@ def plotWms(ax, results, showTotal=True):
         wmsResults frosm calWms.
     showTotal: bool
         If True, plot sum of the given results in the list.
+    lines: dict, default=None
+        Persistent Line2D handles for the axis, see plotDas.
 
     Returns
     -------
 
     """
-    sumWms = np.zeros(results[0]['nu'].shape)
+    keys = list(range(len(results)))
+    if showTotal:
+        keys.append('total')
+    reuse = canReuseLines(ax, lines, keys)
+    if not reuse:
+        ax.clear()
+        if lines is not None:
+            lines.clear()
+    spec = np.stack([result['spectrum'] for result in results])
     for idx, result in enumerate(results):
         nu = result['nu']
-        spectrum = result['spectrum']
-        gasParams = result['gasParams']
-        ax.plot(nu, spectrum, label=strGasParams(gasParams))
-        sumWms = sumWms + spectrum
-        if idx == 0:
-            ax.hold(True)
+        setPlotLine(ax, lines, reuse, idx, nu, spec[idx],
+                    strGasParams(result['gasParams']))
     if showTotal:
-        ax.plot(nu, sumWms, label='Total')
+        setPlotLine(ax, lines, reuse, 'total', nu, spec.sum(0), 'Total')
+    if reuse:
+        ax.relim()
+        ax.autoscale_view()
     leg = ax.legend(fontsize=11, loc=2, frameon=False)
     if leg:
         leg.draggable()
@@ -523,7 +921,6 @@ def plotWms(ax, results, showTotal=True):
     ax.set_xlim([nu.min(), nu.max()])
     ax.set_ylabel('WMS ' + str(results[0]['nf']) + 'f (Mod depth: ' + str(
         results[0]['modDepth']) + ' cm$^{-1}$)')
-    ax.hold(False)
 
 
 def generateEtalons(etalonParams):
@@ -589,66 +986,38 @@ def csvOutput(csvFile, results):
     error: bool
         If there's an error, will return True.
     """
-    headers = []
-
-    # Generate a line for gas names
-    line = 'Gas:,'
-    for result in results:
-        line += (result['gasParams']['gas'] + ',')
-    headers.append(line[:-1])
-    print line
-
-    # Generate a line for path length
-    line = 'Path lenght (cm):,'
-    for result in results:
-        line += (str(result['gasParams']['l']) + ',')
-    headers.append(line[:-1])
-
-    # Generate a line for concentration
-    line = 'Conc. (volume ratio),'
-    for result in results:
-        line += (str(result['gasParams']['c']) + ',')
-    headers.append(line[:-1])
-
-    # Generate a line for pressure
-    line = 'Pressure (hPa),'
-    for result in results:
-        line += (str(result['gasParams']['p']) + ',')
-    headers.append(line[:-1])
-
-    # Genearte a line for temperature
-    line = 'Temperature (K),'
-    for result in results:
-        line += (str(result['gasParams']['t']) + ',')
-    headers.append(line[:-1])
-
-    # Separator
-    line = '--,'
-    for result in results:
-        line += ('--,')
-    headers.append(line[:-1])
-
-    line = 'Nu (cm^-1),'
-    for idx, result in enumerate(results):
-        line += ('spec' + str(idx) + ',')
-    headers.append(line[:-1])
+    def gasParamLine(label, key):
+        # One header line: label followed by the per-gas values
+        return label + ',' + ','.join(
+            str(result['gasParams'][key]) for result in results)
+
+    headers = [gasParamLine('Gas:', 'gas'),
+               gasParamLine('Path lenght (cm):', 'l'),
+               gasParamLine('Conc. (volume ratio)', 'c'),
+               gasParamLine('Pressure (hPa)', 'p'),
+               gasParamLine('Temperature (K)', 't'),
+               '--,' + ','.join('--' for _ in results),
+               'Nu (cm^-1),' + ','.join(
+                   'spec' + str(idx) for idx in range(len(results)))]
 
     nu = results[0]['nu']
-    print len(nu)
+    print(len(nu))
     spectra = []
     for result in results:
         spectra.append(result['spectrum'])
 
-    print headers
-    print '!'
-    with open(csvFile, 'wb') as f:
-        for line in headers:
-            f.write(line + '\n')
-        for idx, n in enumerate(nu):
-            line = str(n) + ','
-            for spectrum in spectra:
-                line += (str(spectrum[idx]) + ',')
-            f.write(line[:-1] + '\n')
+    print(headers)
+    # Binary mode on py2, text with universal newlines suppressed on py3
+    if sys.version_info[0] < 3:
+        f = open(csvFile, 'wb')
+    else:
+        f = open(csvFile, 'w', newline='')
+    with f:
+        f.write('\n'.join(headers) + '\n')
+        # One contiguous (N, 1 + nSpec) block, formatted in C by savetxt
+        # instead of a Python string build per row.
+        np.savetxt(f, np.column_stack([nu] + spectra), delimiter=',',
+                   fmt='%.12g')
 
 
 def main():
@@ -661,7 +1030,7 @@ def main():
     """
 
     hapi.db_begin_pickle('./Data')
-    print 'specCal is package from spectroscopy calculation for QCL spectroscopy.'
+    print('specCal is package from spectroscopy calculation for QCL spectroscopy.')
 
 
 main()
@@ -0,0 +1,32 @@
+"""
+One-time conversion of HITRAN .mat line files to .npz arrays.
+
+lineInfo prefers <molec>.npz when present, which skips scipy's MATLAB
+header parsing on every load; run this script once per data directory
+to generate the npz files next to the mat originals.
+
+Usage: python tools/mat2npz.py [dataDir]
+"""
+import os
+import sys
+
+sys.path.insert(0,
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lineInfo
+
+
+def main():
+    if len(sys.argv) > 1:
+        location = sys.argv[1]
+    else:
+        location = './Data'
+    converted = lineInfo.matToNpz(location)
+    if converted:
+        print('Converted: ' + ', '.join(converted))
+    else:
+        print('No .mat files found in ' + location)
+
+
+if __name__ == '__main__':
+    main()